@@ -1,14 +1,48 @@
 #!/usr/bin/env python3
 import argparse
+import codecs
+import http.client
+import io
 import json
+import mmap
 import re
 import shlex
 import subprocess
 import sys
+import tempfile
 import time
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
-from urllib.request import Request, urlopen
+from typing import (
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Pattern,
+    Tuple,
+    Union,
+)
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+
+MAX_REDIRECTS = 10
+REGION_CODE = re.compile(r"[A-Z0-9_-]{1,8}")
+SPOOL_CHUNK_SIZE = 8192
+LARGE_BODY_THRESHOLD = 1024 * 1024
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+IDEMPOTENT_METHODS = {"GET", "HEAD"}
+
+TELEGRAM_HOST = "api.telegram.org"
+TELEGRAM_MAX_RETRIES = 3
+TELEGRAM_MIN_GAP = 1.0
+TELEGRAM_MAX_RETRY_AFTER = 60.0
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+_last_telegram_send = float("-inf")
+_timestamp_cache: Tuple[int, str] = (-1, "")
+
+# Open connections keyed by (scheme, host, port), reused across polls.
+_connections: Dict[Tuple[str, str, int], http.client.HTTPConnection] = {}
 
 
 def load_headers(headers_json: Optional[str]) -> Dict[str, str]:
@@ -20,68 +54,318 @@ def load_headers(headers_json: Optional[str]) -> Dict[str, str]:
         raise ValueError(f"Invalid JSON for headers: {exc}") from exc
 
 
-def fetch_url(url: str, method: str, headers: Dict[str, str], timeout: int) -> str:
-    request = Request(url, method=method, headers=headers)
-    with urlopen(request, timeout=timeout) as response:
-        charset = response.headers.get_content_charset() or "utf-8"
-        return response.read().decode(charset, errors="replace")
+def get_connection(
+    scheme: str, host: str, port: int, timeout: int
+) -> Tuple[http.client.HTTPConnection, bool]:
+    key = (scheme, host, port)
+    connection = _connections.get(key)
+    if connection is not None:
+        return connection, True
+    if scheme == "https":
+        connection = http.client.HTTPSConnection(host, port, timeout=timeout)
+    elif scheme == "http":
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    else:
+        raise ValueError(f"Unsupported URL scheme: {scheme!r}")
+    _connections[key] = connection
+    return connection, False
+
+
+def drop_connection(scheme: str, host: str, port: int) -> None:
+    connection = _connections.pop((scheme, host, port), None)
+    if connection is not None:
+        connection.close()
+
+
+# With spool_large, large bodies are returned as a read-only mmap of a
+# temporary file instead of bytes. Both support find() and regex searches;
+# `in` does not work for substrings on mmap, so callers use find().
+Body = Union[bytes, mmap.mmap]
+
+
+def response_charset(response: http.client.HTTPResponse) -> str:
+    return codecs.lookup(response.headers.get_content_charset() or "utf-8").name
+
+
+def read_large(response: http.client.HTTPResponse) -> Body:
+    with tempfile.TemporaryFile() as spool:
+        while True:
+            chunk = response.read(SPOOL_CHUNK_SIZE)
+            if not chunk:
+                break
+            spool.write(chunk)
+        spool.flush()
+        if not spool.tell():
+            return b""
+        return mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def http_request(
+    url: str,
+    method: str,
+    headers: Dict[str, str],
+    timeout: int,
+    data: Optional[bytes] = None,
+    spool_large: bool = False,
+) -> Tuple[http.client.HTTPResponse, Body]:
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        host = parts.hostname or ""
+        port = parts.port or (443 if scheme == "https" else 80)
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+        if method not in IDEMPOTENT_METHODS:
+            # A request that cannot be retried safely never goes out on a
+            # pooled connection the server may already have closed as idle.
+            drop_connection(scheme, host, port)
+        while True:
+            connection, reused = get_connection(scheme, host, port, timeout)
+            try:
+                connection.request(method, path, body=data, headers=headers)
+                response = connection.getresponse()
+                if spool_large and (response.length or 0) > LARGE_BODY_THRESHOLD:
+                    body = read_large(response)
+                else:
+                    body = response.read()
+            except ConnectionError:
+                drop_connection(scheme, host, port)
+                # The server may have closed an idle keep-alive connection
+                # between polls; retry once on a fresh one. Requests that may
+                # already have been processed (POST) are not resent.
+                if reused and method in IDEMPOTENT_METHODS:
+                    continue
+                raise
+            except Exception:
+                drop_connection(scheme, host, port)
+                raise
+            break
+        if response.will_close:
+            drop_connection(scheme, host, port)
+        location = response.headers.get("Location")
+        if response.status in REDIRECT_STATUSES and location:
+            url = urljoin(url, location)
+            if response.status == 303 or (
+                response.status in (301, 302) and method == "POST"
+            ):
+                method, data = "GET", None
+            continue
+        # Like urlopen, any non-2xx response that was not redirected is an error.
+        if response.status >= 300:
+            raise HTTPError(
+                url,
+                response.status,
+                response.reason,
+                response.headers,
+                io.BytesIO(body),
+            )
+        return response, body
+    raise HTTPError(
+        url, response.status, "Too many redirects", response.headers, None
+    )
+
+
+def fetch_url(
+    url: str,
+    method: str,
+    headers: Dict[str, str],
+    timeout: int,
+    spool_large: bool = False,
+) -> Body:
+    # The body is scanned as UTF-8 bytes; other charsets are transcoded first.
+    response, body = http_request(
+        url, method, headers, timeout, spool_large=spool_large
+    )
+    charset = response_charset(response)
+    if charset not in ("utf-8", "ascii"):
+        body = bytes(body).decode(charset, errors="replace").encode("utf-8")
+    return body
+
+
+KeywordNeedles = List[Tuple[str, bytes]]
+
+
+def encode_keywords(keywords: List[str], case_insensitive: bool) -> KeywordNeedles:
+    needles: KeywordNeedles = []
+    for keyword in dict.fromkeys(keywords):
+        needle = keyword.encode("utf-8")
+        needles.append((keyword, needle.upper() if case_insensitive else needle))
+    return needles
+
+
+def build_keyword_scanner(keywords: KeywordNeedles) -> Optional[Pattern[bytes]]:
+    if not keywords:
+        return None
+    # Longest first so the alternation prefers the longest keyword at a position.
+    ordered = sorted({needle for _, needle in keywords}, key=len, reverse=True)
+    return re.compile(b"|".join(re.escape(needle) for needle in ordered))
 
 
 def matches(
-    content: str, keywords: List[str], regexes: List[str]
+    content: Body,
+    keywords: KeywordNeedles,
+    keyword_scanner: Optional[Pattern[bytes]],
+    regexes: List[Pattern[str]],
+    content_upper: Optional[bytes] = None,
+    first_only: bool = False,
 ) -> Tuple[bool, List[str]]:
+    # With content_upper set, keywords are matched case-insensitively against
+    # it and the keyword needles are expected to be uppercased.
+    # first_only stops at the first hit when the caller does not need them all.
     hits: List[str] = []
-    for keyword in keywords:
-        if keyword in content:
-            hits.append(f"keyword:{keyword}")
+    if keyword_scanner:
+        keyword_content = content if content_upper is None else content_upper
+        if first_only:
+            match = keyword_scanner.search(keyword_content)
+            if match:
+                for keyword, needle in keywords:
+                    if needle == match.group():
+                        return True, [f"keyword:{keyword}"]
+        else:
+            found = {
+                match.group() for match in keyword_scanner.finditer(keyword_content)
+            }
+            # The scan reports non-overlapping hits only, so a keyword overlapping
+            # another hit may be missing from `found`. No hit at all means no
+            # keyword occurs, which is the common case while polling.
+            for keyword, needle in keywords:
+                if needle in found or (found and keyword_content.find(needle) != -1):
+                    hits.append(f"keyword:{keyword}")
+    # User regexes run on the decoded text so non-ASCII classes and `.` match
+    # whole characters; the page is only decoded when there are regexes.
+    text = bytes(content).decode("utf-8", errors="replace") if regexes else ""
     for regex in regexes:
-        if re.search(regex, content):
-            hits.append(f"regex:{regex}")
+        if regex.search(text):
+            hits.append(f"regex:{regex.pattern}")
+            if first_only:
+                break
     return bool(hits), hits
 
 
-def build_region_regex(regions: List[str]) -> Optional[str]:
-    cleaned = [region.strip().upper() for region in regions if region.strip()]
-    if not cleaned:
+def compile_regexes(regexes: List[str]) -> List[Pattern[str]]:
+    compiled: List[Pattern[str]] = []
+    for regex in regexes:
+        try:
+            compiled.append(re.compile(regex))
+        except re.error as exc:
+            raise ValueError(f"Invalid regex {regex!r}: {exc}") from exc
+    return compiled
+
+
+def clean_regions(regions: List[str]) -> List[str]:
+    cleaned = list(
+        dict.fromkeys(region.strip().upper() for region in regions if region.strip())
+    )
+    for region in cleaned:
+        if not REGION_CODE.fullmatch(region):
+            raise ValueError(f"Invalid region code: {region!r}")
+    return cleaned
+
+
+def build_region_regex(regions: List[str]) -> Optional[Pattern[bytes]]:
+    # Expects codes from clean_regions(), which contain no regex metacharacters.
+    if not regions:
         return None
-    pattern = "|".join(re.escape(region) for region in cleaned)
-    return rf"\b(?:{pattern})\b"
+    pattern = "|".join(regions)
+    return re.compile(rf"\b(?:{pattern})\b".encode(), re.ASCII)
+
+
+def region_present(
+    content: Body, region_tokens: List[bytes], region_regex: Pattern[bytes]
+) -> bool:
+    # Plain substring searches rule out most pages far faster than the
+    # word-boundary alternation; the regex then only confirms the boundaries,
+    # starting from the earliest candidate.
+    candidates = [content.find(token) for token in region_tokens]
+    starts = [start for start in candidates if start >= 0]
+    if not starts:
+        return False
+    return region_regex.search(content, min(starts)) is not None
+
+
+REGION_WINDOW = 256
 
 
 def region_is_available(
-    content: str, regions: List[str], unavailable_text: str
+    content: Body,
+    region_tokens: List[bytes],
+    region_regex: Optional[Pattern[bytes]],
+    unavailable_text: bytes,
 ) -> Tuple[bool, List[str]]:
-    available: List[str] = []
-    for region in regions:
-        region_token = region.strip().upper()
-        if not region_token:
-            continue
-        region_pattern = re.escape(region_token)
-        unavailable_pattern = (
-            rf"\b{region_pattern}\b.*?{re.escape(unavailable_text)}"
-        )
-        if re.search(unavailable_pattern, content, re.IGNORECASE | re.DOTALL):
+    # Region codes are found case-sensitively, like the region filter, so
+    # words such as "in" are not taken for a region. Only the window after
+    # each occurrence is uppercased to look for the (uppercased) unavailable
+    # text. A region counts as available when at least one of its occurrences
+    # is not followed by that text within REGION_WINDOW bytes.
+    if region_regex is None:
+        return False, []
+    available = set()
+    for match in region_regex.finditer(content):
+        region = match.group()
+        if region in available:
             continue
-        if re.search(rf"\b{region_pattern}\b", content, re.IGNORECASE):
-            available.append(region_token)
-    return bool(available), available
+        window = content[match.end() : match.end() + REGION_WINDOW].upper()
+        if unavailable_text not in window:
+            available.add(region)
+    regions = [token.decode() for token in region_tokens if token in available]
+    return bool(regions), regions
 
 
-def run_command(command: str) -> None:
-    subprocess.run(shlex.split(command), check=False)
+def run_command(argv: List[str]) -> "subprocess.Popen[bytes]":
+    # Started without waiting so a slow command does not delay the next poll.
+    return subprocess.Popen(argv)
+
+
+def telegram_retry_after(exc: HTTPError) -> float:
+    retry_after = exc.headers.get("Retry-After") if exc.headers else None
+    try:
+        parameters = json.loads(exc.read()).get("parameters", {})
+        retry_after = parameters.get("retry_after", retry_after)
+    except (ValueError, AttributeError):
+        pass
+    try:
+        return max(0.0, float(retry_after))
+    except (TypeError, ValueError):
+        return 1.0
 
 
 def send_telegram_message(token: str, chat_id: str, text: str, timeout: int) -> None:
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
-    payload = json.dumps({"chat_id": chat_id, "text": text}).encode("utf-8")
-    request = Request(
-        url,
-        data=payload,
-        headers={"Content-Type": "application/json"},
-        method="POST",
-    )
-    with urlopen(request, timeout=timeout):
-        return None
+    global _last_telegram_send
+    url = f"https://{TELEGRAM_HOST}/bot{token}/sendMessage"
+    payload = json.dumps(
+        {"chat_id": chat_id, "text": text}, separators=(",", ":")
+    ).encode("utf-8")
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        wait = _last_telegram_send + TELEGRAM_MIN_GAP - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            http_request(
+                url, "POST", {"Content-Type": "application/json"}, timeout, data=payload
+            )
+            return
+        except HTTPError as exc:
+            if exc.code != 429 or attempt == TELEGRAM_MAX_RETRIES:
+                raise
+            retry_after = telegram_retry_after(exc)
+            if retry_after > TELEGRAM_MAX_RETRY_AFTER:
+                raise
+            time.sleep(retry_after)
+        finally:
+            _last_telegram_send = time.monotonic()
+            # Sends are far apart, so do not hold the socket open across the
+            # retry_after wait; every attempt goes out on a fresh connection.
+            drop_connection("https", TELEGRAM_HOST, 443)
+
+
+def current_timestamp() -> str:
+    # Formatted at most once per second; log lines only show whole seconds.
+    global _timestamp_cache
+    now = int(time.time())
+    if now != _timestamp_cache[0]:
+        _timestamp_cache = (now, time.strftime(TIMESTAMP_FORMAT, time.localtime(now)))
+    return _timestamp_cache[1]
 
 
 def align_to_next_hour() -> None:
@@ -92,6 +376,18 @@ def align_to_next_hour() -> None:
         time.sleep(sleep_seconds)
 
 
+def sleep_until_next_tick(next_tick: float, interval: int) -> float:
+    # Schedules polls on a fixed monotonic grid so request latency does not
+    # stretch the period; slots missed by a slow poll are skipped.
+    next_tick += interval
+    now = time.monotonic()
+    if interval > 0 and next_tick < now:
+        next_tick += ((now - next_tick) // interval + 1) * interval
+    if next_tick > now:
+        time.sleep(next_tick - now)
+    return next_tick
+
+
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         description="Poll a URL and notify when content matches a keyword or regex."
@@ -116,6 +412,11 @@ def build_parser() -> argparse.ArgumentParser:
         default=[],
         help="Regex pattern to match in the response body (repeatable).",
     )
+    parser.add_argument(
+        "--case-insensitive",
+        action="store_true",
+        help="Match keywords regardless of ASCII case.",
+    )
     parser.add_argument(
         "--region",
         action="append",
@@ -161,6 +462,15 @@ def build_parser() -> argparse.ArgumentParser:
         default="Resource is available.",
         help="Message text to send to Telegram (default: %(default)s).",
     )
+    parser.add_argument(
+        "--telegram-min-interval",
+        type=int,
+        default=300,
+        help=(
+            "Minimum seconds between Telegram notifications; repeats of the "
+            "same match are not re-sent (default: %(default)s)."
+        ),
+    )
     parser.add_argument(
         "--include-matches",
         action="store_true",
@@ -198,58 +508,151 @@ def main() -> int:
         args.telegram_chat_id and not args.telegram_token
     ):
         parser.error("Provide both --telegram-token and --telegram-chat-id together.")
+    if args.interval < 0:
+        parser.error("--interval must not be negative.")
 
     headers = {"User-Agent": "hidencloud-notifier/1.0"}
     headers.update(load_headers(args.headers))
-    region_regex = build_region_regex(args.region)
-    region_unavailable_text = args.region_unavailable_text
+    try:
+        regex_patterns = compile_regexes(args.regex)
+    except ValueError as exc:
+        parser.error(str(exc))
+    keyword_needles = encode_keywords(args.keyword, args.case_insensitive)
+    keyword_scanner = build_keyword_scanner(keyword_needles)
+    try:
+        regions = clean_regions(args.region)
+    except ValueError as exc:
+        parser.error(str(exc))
+    region_regex = build_region_regex(regions)
+    try:
+        command_argv = shlex.split(args.command) if args.command else None
+    except ValueError as exc:
+        parser.error(f"Invalid --command: {exc}")
+    command_process: Optional["subprocess.Popen[bytes]"] = None
+    region_tokens = [region.encode() for region in regions]
+    region_unavailable_text = args.region_unavailable_text.encode("utf-8").upper()
+    case_insensitive = args.case_insensitive
+    include_matches = args.include_matches
+    check_available = args.region_available and bool(args.region)
+    notify_telegram = bool(args.telegram_token and args.telegram_chat_id)
+    # The full hit list is needed for --include-matches and for the Telegram
+    # dedupe state; otherwise matching can stop at the first hit.
+    need_all_hits = include_matches or notify_telegram
+    # Mapping a large body from disk only saves memory when nothing copies the
+    # whole page afterwards: --case-insensitive uppercases it and --regex
+    # decodes it, so those runs read the body into memory directly.
+    spool_large = not case_insensitive and not regex_patterns
 
     if args.align_hour:
         align_to_next_hour()
 
+    # Plain locals for everything the loop reads on each poll.
+    url, method, timeout, interval = args.url, args.method, args.timeout, args.interval
+    telegram_token, telegram_chat_id = args.telegram_token, args.telegram_chat_id
+    telegram_message, once = args.telegram_message, args.once
+    telegram_min_interval = args.telegram_min_interval
+    last_notified_state: FrozenSet[str] = frozenset()
+    last_notified_at = float("-inf")
+
+    next_tick = time.monotonic()
     while True:
         try:
-            content = fetch_url(args.url, args.method, headers, args.timeout)
+            content = fetch_url(url, method, headers, timeout, spool_large)
         except Exception as exc:
-            timestamp = datetime.now().isoformat(timespec="seconds")
+            timestamp = current_timestamp()
             print(f"[{timestamp}] Request failed: {exc}", file=sys.stderr)
         else:
+            # Region checks are cheaper and usually fail while nothing is
+            # available, so run them before scanning for keywords and regexes.
             region_ok = True
             available_regions: List[str] = []
-            if region_regex:
-                region_ok = re.search(region_regex, content) is not None
-            if region_ok and args.region_available and args.region:
-                region_ok, available_regions = region_is_available(
-                    content, args.region, region_unavailable_text
+            matched = False
+            hits: List[str] = []
+            if region_regex and not region_present(
+                content, region_tokens, region_regex
+            ):
+                region_ok = False
+            if region_ok:
+                if check_available:
+                    region_ok, available_regions = region_is_available(
+                        content,
+                        region_tokens,
+                        region_regex,
+                        region_unavailable_text,
+                    )
+            if region_ok:
+                content_upper: Optional[bytes] = None
+                if case_insensitive:
+                    content_upper = bytes(content).upper()
+                matched, hits = matches(
+                    content,
+                    keyword_needles,
+                    keyword_scanner,
+                    regex_patterns,
+                    content_upper,
+                    first_only=not need_all_hits,
                 )
-            matched, hits = matches(content, args.keyword, args.regex)
-            if matched and region_ok:
-                timestamp = datetime.now().isoformat(timespec="seconds")
+            if matched:
+                timestamp = current_timestamp()
                 print(f"[{timestamp}] Match detected.")
-                if args.command:
-                    run_command(args.command)
-                if args.telegram_token and args.telegram_chat_id:
-                    message = args.telegram_message
-                    if args.region_available and available_regions:
+                notify_failed = False
+                if command_argv:
+                    # Runs stay one at a time: no new run while the last one
+                    # (e.g. a long alarm) is still going.
+                    if command_process is None or command_process.poll() is not None:
+                        command_process = run_command(command_argv)
+                # Only notify when the matched state changes, and no more
+                # often than --telegram-min-interval, so a page that stays
+                # available does not produce a message every poll.
+                state = frozenset(
+                    hits + [f"region:{region}" for region in available_regions]
+                )
+                if (
+                    notify_telegram
+                    and state != last_notified_state
+                    and time.monotonic() - last_notified_at >= telegram_min_interval
+                ):
+                    message = telegram_message
+                    if available_regions:
                         message = format_region_message(message, available_regions)
-                    if args.include_matches:
+                    if include_matches:
                         match_details = hits[:]
                         if region_regex:
-                            match_details.append(f"region:{region_regex}")
+                            match_details.append(
+                                f"region:{region_regex.pattern.decode()}"
+                            )
                         if available_regions:
                             match_details.append(
                                 f"region_available:{', '.join(available_regions)}"
                             )
                         message = f"{message}\nMatches: {', '.join(match_details)}"
-                    send_telegram_message(
-                        args.telegram_token,
-                        args.telegram_chat_id,
-                        message,
-                        args.timeout,
-                    )
-                if args.once:
-                    return 0
-        time.sleep(args.interval)
+                    try:
+                        send_telegram_message(
+                            telegram_token,
+                            telegram_chat_id,
+                            message,
+                            timeout,
+                        )
+                        last_notified_state = state
+                        last_notified_at = time.monotonic()
+                    except Exception as exc:
+                        notify_failed = True
+                        print(
+                            f"[{timestamp}] Telegram notification failed: {exc}",
+                            file=sys.stderr,
+                        )
+                if once:
+                    if command_process is not None:
+                        command_process.wait()
+                    # A lost notification must not look like a successful run.
+                    return 1 if notify_failed else 0
+            else:
+                # Forget the last state so the next match is reported again.
+                last_notified_state = frozenset()
+        # Reap a finished command so it does not linger as a zombie.
+        if command_process is not None and command_process.poll() is not None:
+            command_process = None
+        next_tick = sleep_until_next_tick(next_tick, interval)
 
 
 if __name__ == "__main__":